@@ -1,20 +1,124 @@
-from os import path
-from time import sleep
+from os import path, stat, stat_result, makedirs, SEEK_END
 from pathlib import Path
-from subprocess import run
+from mmap import mmap, ACCESS_READ
+from shutil import copyfileobj
+from subprocess import run, STDOUT
+from tempfile import TemporaryFile
+from itertools import islice
 from os import linesep as ls
 from datetime import datetime
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
 from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 from jinja2 import Environment, PackageLoader, select_autoescape
 
+import re
 import logging
 import requests
-import platform
 import tarfile
 
+from .cache import MetadataCache
+from .enums import _SYSTEM_LOWER
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 LOG = logging.getLogger(__name__)
 LOG.addHandler(logging.NullHandler())
 
+# Shared by all servers so packaged templates are only loaded and compiled
+# once per process, templates don't change once installed
+_J2_ENV = Environment(
+    loader=PackageLoader("steamcmd"),
+    autoescape=select_autoescape(),
+    auto_reload=False,
+    cache_size=-1,
+)
+
+# Matches a non-comment server.cfg line, capturing the setting name
+_CFG_SETTING_RE = re.compile(rb"^(?!//)[ \t]*(\S+)[^\r\n]*", re.MULTILINE)
+
+
+def _format_setting(key: str, value) -> str:
+    """
+    Formats a setting as a server.cfg line without the line ending, strings
+    are quoted and ints are written as is
+
+    :return: The formatted line, or None if the value type isn't supported
+    """
+    if isinstance(value, str):
+        return f'{key} "{value}"'
+    elif isinstance(value, int):
+        return f"{key} {value}"
+    return None
+
+
+class _TeeReader:
+    def __init__(self, src, sink) -> None:
+        """
+        File like object which writes everything read from src to sink
+
+        :param src: The file like object to read from
+        :param sink: The file like object to copy the read data into
+        """
+        self.src = src
+        self.sink = sink
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.src.read(size)
+        self.sink.write(data)
+        return data
+
+
+def _changed_members(tar: tarfile.TarFile, extract_path: str):
+    """
+    Yields the members of tar except regular files which already exist in
+    the extract path with the same size and an mtime at least as new.
+
+    The parent directory of each member is created before it's yielded,
+    tarfile creates missing parents without tolerating another thread
+    creating them first, which races when archives are extracted into the
+    same tree concurrently.
+
+    :param tar: The open tarfile to iterate over
+    :param extract_path: The directory the tarfile is being extracted to
+    """
+    root = path.realpath(extract_path)
+    for member in tar:
+        member_path = path.join(extract_path, member.name)
+        parent = path.realpath(path.dirname(member_path))
+        target = path.join(parent, path.basename(member_path))
+        if member.isfile():
+            try:
+                local_stat = stat(target)
+            except FileNotFoundError:
+                local_stat = None
+            if (
+                local_stat is not None
+                and local_stat.st_size == member.size
+                and local_stat.st_mtime >= member.mtime
+            ):
+                continue
+        # Members resolving outside the extract path are left to tarfile
+        # to reject rather than creating directories for them
+        if path.commonpath([root, parent]) == root:
+            makedirs(parent, exist_ok=True)
+        yield member
+
+
+def _batched(iterable, size: int):
+    """
+    Yields lists of at most size items from iterable
+    """
+    it = iter(iterable)
+    batch = list(islice(it, size))
+    while batch:
+        yield batch
+        batch = list(islice(it, size))
+
 
 class ServerBase:
     # https://steamapi.xpaw.me/#ISteamRemoteStorage/GetCollectionDetails
@@ -25,6 +129,12 @@ class ServerBase:
     # itemcount, Number of items being requested
     # publishedfileids[arr], List of published file id to look up
     get_file_details_url = "https://api.steampowered.com/ISteamRemoteStorage/GetPublishedFileDetails/v1/"
+    # Number of concurrent workshop downloads and Steam API batch requests
+    download_workers = 8
+    # Size in bytes of each read/write when streaming a download to disk
+    download_chunk_size = 1024 * 1024
+    # Bytes of steamcmd output included in the error when an install fails
+    error_tail_size = 16 * 1024
 
     def __init__(
         self,
@@ -36,6 +146,8 @@ class ServerBase:
         password: str = None,
         server_ref: str = "0",
         install_sourcemod: bool = False,
+        metadata_cache_path: str = "~/.cache/steamcmd/meta",
+        metadata_cache_ttl: int = 3600,
     ) -> None:
         """
         This class is designed to help simplify installing applications using
@@ -56,6 +168,10 @@ class ServerBase:
             install path
         :param install_sourcemod: If True will install metamod and sourcemod
             onto the server, only works if the server is a source server
+        :param metadata_cache_path: Directory used to cache Steam API
+            workshop metadata, set to None to disable the cache
+        :param metadata_cache_ttl: The number of seconds cached Steam API
+            metadata is used before being revalidated
         """
         self.app_id = app_id
         self.steamcmd_path = steamcmd_path
@@ -75,10 +191,32 @@ class ServerBase:
             f"{self.install_base_path}/{self.app_id}/{self.server_ref}"
         )
         self.SOURCE_MOD_GAME = False
-        self.j2 = Environment(
-            loader=PackageLoader("steamcmd"),
-            autoescape=select_autoescape(),
+        self.metadata_cache = None
+        if metadata_cache_path is not None:
+            self.metadata_cache = MetadataCache(
+                metadata_cache_path, metadata_cache_ttl
+            )
+        self.j2 = _J2_ENV
+
+        # A shared session keeps connections to the Steam and AlliedMods
+        # hosts alive between requests instead of reconnecting for each call,
+        # the pool is sized so every concurrent worker can keep a connection
+        self.http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=max(16, self.download_workers),
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "POST", "HEAD"],
+                # Hand the last response back once retries run out so
+                # callers still get an HTTPError from raise_for_status
+                raise_on_status=False,
+            ),
         )
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
 
     def install_app(
         self,
@@ -116,18 +254,27 @@ class ServerBase:
 
         try:
             if self.steamcmd_script_path.exists():
-                result = run(
-                    args=[
-                        self.steamcmd_path,
-                        "+runscript",
-                        self.steamcmd_script_path.absolute(),
-                    ],
-                    capture_output=True,
-                )
-                if result.returncode != 0:
-                    raise Exception(
-                        f"Error when installing app: {self.app_id}, server reference: {self.server_ref}, stdout:{ls}{result.stdout}{ls}{ls}stderr:{ls}{result.stderr}"
+                # steamcmd output is only needed on failure, send it to a
+                # temporary file rather than holding it all in memory
+                with TemporaryFile() as output:
+                    result = run(
+                        args=[
+                            self.steamcmd_path,
+                            "+runscript",
+                            self.steamcmd_script_path.absolute(),
+                        ],
+                        stdout=output,
+                        stderr=STDOUT,
                     )
+                    if result.returncode != 0:
+                        output.seek(0, SEEK_END)
+                        output.seek(
+                            max(0, output.tell() - self.error_tail_size)
+                        )
+                        tail = output.read().decode("UTF-8", "replace")
+                        raise Exception(
+                            f"Error when installing app: {self.app_id}, server reference: {self.server_ref}, output (last {self.error_tail_size} bytes):{ls}{tail}"
+                        )
         except Exception:
             if self.steamcmd_script_path.exists():
                 self.steamcmd_script_path.unlink()
@@ -163,24 +310,86 @@ class ServerBase:
         file_details = self._get_steam_file_info(file_ids)
         LOG.debug(file_details)
 
-        for k, details in file_details.items():
-            file_path = Path(
-                path.join(
-                    p.absolute(), f"{k}{Path(details['file_name']).suffix}"
+        base_path = str(p.absolute())
+        with ThreadPoolExecutor(max_workers=self.download_workers) as ex:
+            # list() forces the results so worker exceptions are raised here
+            list(
+                ex.map(
+                    lambda item: self._download_workshop_file(
+                        base_path, *item
+                    ),
+                    file_details.items(),
                 )
             )
-            if file_path.exists():
-                if (
-                    file_path.stat().st_size == details["file_size"]
-                    or file_path.stat().st_mtime > details["time_updated"]
-                ):
-                    LOG.info(
-                        f"Skipping {details['file_name']}, already exists"
-                    )
-                    continue
 
-            LOG.info(f"Downloading {details['file_name']}")
-            self._download_file(details["file_url"], file_path)
+    def _download_workshop_file(
+        self, install_path: str, file_id: str, details: dict
+    ) -> None:
+        """
+        Downloads a single workshop file into the install path unless an up to
+        date copy is already present
+
+        :param install_path: The directory to store the file in
+        :param file_id: The published file ID of the workshop file
+        :param details: The file details as returned by _get_steam_file_info
+        """
+        # Called once per workshop file so this sticks to plain strings and a
+        # single stat call rather than building Path objects
+        file_path = path.join(
+            install_path,
+            f"{file_id}{path.splitext(details['file_name'])[1]}",
+        )
+        try:
+            local_stat = stat(file_path)
+        except FileNotFoundError:
+            local_stat = None
+
+        if local_stat is not None:
+            if (
+                local_stat.st_size == details["file_size"]
+                or local_stat.st_mtime > details["time_updated"]
+            ):
+                LOG.info(f"Skipping {details['file_name']}, already exists")
+                return
+
+            if self._remote_file_unchanged(details["file_url"], local_stat):
+                LOG.info(f"Skipping {details['file_name']}, not modified")
+                return
+
+        LOG.info(f"Downloading {details['file_name']}")
+        self._download_file(details["file_url"], Path(file_path))
+
+    def _remote_file_unchanged(
+        self, file_url: str, local_stat: stat_result
+    ) -> bool:
+        """
+        Sends a HEAD request for the URL and compares the Content-Length and
+        Last-Modified headers against the local copy of the file
+
+        :param file_url: The URL the file would be downloaded from
+        :param local_stat: The stat result of the local copy of the file
+
+        :return: True if the local file matches the remote file, False if it
+            differs or the remote headers are missing or malformed
+        """
+        resp = self.http.head(file_url, allow_redirects=True)
+        if resp.status_code != 200:
+            return False
+
+        remote_size = resp.headers.get("Content-Length")
+        remote_modified = resp.headers.get("Last-Modified")
+        if remote_size is None or remote_modified is None:
+            return False
+
+        try:
+            return (
+                int(remote_size) == local_stat.st_size
+                and parsedate_to_datetime(remote_modified).timestamp()
+                <= local_stat.st_mtime
+            )
+        except (TypeError, ValueError):
+            # A malformed header can't prove the file is unchanged
+            return False
 
     def _download_file(self, file_url: str, file_path: Path):
         """
@@ -189,86 +398,169 @@ class ServerBase:
         :param file_url: The URL to download from
         :param file_path: The path to store the file on disk
         """
-        with requests.get(file_url, stream=True) as r:
+        with self.http.get(file_url, stream=True) as r:
             r.raise_for_status()
+            r.raw.decode_content = True
             with open(file_path.absolute(), "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                copyfileobj(r.raw, f, length=self.download_chunk_size)
 
     def _get_collection_file_ids(
-        self, collection_ids: list, retries: int = 5, retry_seconds: int = 5
+        self,
+        collection_ids: list,
+        max_batch_size: int = 100,
     ) -> list:
         """
         Uses the Steam API to lookup the file details from a collection
 
         :param collection_ids: A list of IDs to lookup
+        :param max_batch_size: The maximum number of IDs to send in a single
+            request, larger lists are split and requested concurrently
 
         :return: A list of file IDs
         """
-        data = {"collectioncount": str(len(collection_ids))}
-        for i, v in enumerate(collection_ids):
-            data[f"publishedfileids[{i}]"] = v
-
-        for _ in range(retries):
-            resp = requests.post(self.get_collection_url, data=data)
-            if resp.status_code == 200:
-                break
-            sleep(retry_seconds)
-
-        if resp.status_code != 200:
-            raise Exception(
-                f"Error downloading collection IDs after {retries} retries from {self.get_collection_url}, Response code: {resp.status_code}, Content: {resp.content}"
-            )
-
-        collections = resp.json()
+        batches = self._steam_api_batch_post(
+            self.get_collection_url,
+            "collectioncount",
+            collection_ids,
+            max_batch_size,
+        )
 
-        resp = []
-        collections = collections["response"]
+        # dict keys give O(1) de-duplication while keeping the file order
+        resp = {}
+        for collections in batches:
+            collections = collections["response"]
 
-        for result in collections["collectiondetails"]:
-            for collection_detail in result["children"]:
-                collection = collection_detail["publishedfileid"]
-                if collection not in resp:
-                    resp.append(collection)
+            for result in collections["collectiondetails"]:
+                for collection_detail in result["children"]:
+                    resp[collection_detail["publishedfileid"]] = None
 
-        return resp
+        return list(resp)
 
     def _get_steam_file_info(
-        self, file_ids: list, retries: int = 5, retry_seconds: int = 5
+        self,
+        file_ids: list,
+        max_batch_size: int = 100,
     ) -> dict:
         """
         Uses the Steam API to lookup and retrieve a limited set of information
         about the file to determine whether or not the files need updating.
 
+        :param file_ids: A list of file IDs to lookup
+        :param max_batch_size: The maximum number of IDs to send in a single
+            request, larger lists are split and requested concurrently
+
         :return: A dictionary of file IDs as keys and file_name file_size,
             time_updated and file_url as responses
         """
-        data = {"itemcount": len(file_ids)}
-        for i, v in enumerate(file_ids):
-            data[f"publishedfileids[{i}]"] = v
+        batches = self._steam_api_batch_post(
+            self.get_file_details_url,
+            "itemcount",
+            file_ids,
+            max_batch_size,
+        )
 
-        for _ in range(retries):
-            resp = requests.post(self.get_file_details_url, data=data)
-            if resp.status_code == 200:
-                break
-            sleep(retry_seconds)
+        result = {}
+        for batch in batches:
+            for file_details in batch["response"]["publishedfiledetails"]:
+                if file_details["publishedfileid"] not in result:
+                    result[file_details["publishedfileid"]] = {
+                        "file_name": file_details["filename"],
+                        "file_size": file_details["file_size"],
+                        "time_updated": file_details["time_updated"],
+                        "file_url": file_details["file_url"],
+                    }
 
-        if resp.status_code != 200:
-            raise Exception(
-                f"Error downloading file info after {retries} retries from {self.get_collection_url}, Response code: {resp.status_code}, Content: {resp.content}"
+        return result
+
+    def _steam_api_batch_post(
+        self,
+        url: str,
+        count_key: str,
+        ids: list,
+        max_batch_size: int,
+    ) -> list:
+        """
+        Splits the IDs into batches of at most max_batch_size and posts each
+        batch to the Steam API concurrently
+
+        :param url: The Steam API URL to post to
+        :param count_key: The name of the field holding the number of IDs
+        :param ids: The IDs to send as publishedfileids
+        :param max_batch_size: The maximum number of IDs per request
+
+        :return: A list of the decoded JSON responses in batch order
+        """
+        if max_batch_size < 1:
+            raise ValueError(
+                f"max_batch_size must be at least 1, got {max_batch_size}"
             )
 
-        result = {}
-        for file_details in resp.json()["response"]["publishedfiledetails"]:
-            if file_details["publishedfileid"] not in result:
-                result[file_details["publishedfileid"]] = {
-                    "file_name": file_details["filename"],
-                    "file_size": file_details["file_size"],
-                    "time_updated": file_details["time_updated"],
-                    "file_url": file_details["file_url"],
-                }
+        batches = list(_batched(ids, max_batch_size))
+        if len(batches) <= 1:
+            return [
+                self._steam_api_post(url, count_key, batch)
+                for batch in batches
+            ]
+
+        workers = min(len(batches), self.download_workers)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            return list(
+                ex.map(
+                    lambda batch: self._steam_api_post(url, count_key, batch),
+                    batches,
+                )
+            )
 
-        return result
+    def _steam_api_post(
+        self,
+        url: str,
+        count_key: str,
+        ids: list,
+    ) -> dict:
+        """
+        Posts a single batch of IDs to the Steam API. Failed requests are
+        retried with backoff by the session's HTTPAdapter.
+
+        Responses are served from the metadata cache while fresh, expired
+        entries are revalidated with If-Modified-Since.
+
+        :param url: The Steam API URL to post to
+        :param count_key: The name of the field holding the number of IDs
+        :param ids: The IDs to send as publishedfileids
+
+        :return: The decoded JSON response
+        """
+        cache_key = None
+        entry = None
+        headers = {}
+        if self.metadata_cache is not None:
+            cache_key = self.metadata_cache.key(url, ids)
+            entry = self.metadata_cache.get(cache_key)
+            if entry is not None:
+                if not entry.is_expired():
+                    LOG.debug(f"Using cached response for {url}")
+                    return entry.body
+                if entry.date:
+                    headers["If-Modified-Since"] = entry.date
+
+        data = {count_key: str(len(ids))}
+        for i, v in enumerate(ids):
+            data[f"publishedfileids[{i}]"] = v
+
+        resp = self.http.post(url, data=data, headers=headers)
+
+        if resp.status_code == 304 and entry is not None:
+            LOG.debug(f"Cached response for {url} not modified")
+            self.metadata_cache.set(cache_key, entry.body, entry.date)
+            return entry.body
+
+        resp.raise_for_status()
+
+        body = json_loads(resp.content)
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(cache_key, body, resp.headers.get("Date"))
+
+        return body
 
     def _allied_mods_download(
         self,
@@ -276,21 +568,23 @@ class ServerBase:
         url_prefix: str,
         version: str,
         latest_suffix: str,
+        extract_path: str,
     ) -> bool:
         """
-        Downloads files from the allied mods website used for pulling metamod
-        and sourcemod
+        Downloads tarballs from the allied mods website used for pulling
+        metamod and sourcemod and extracts them as they are downloaded
 
         :param install_path: Path to download the file to
         :param url_prefix: The prefix of the URL
         :param version: The version of the file to download
         :param latest_suffix: The suffix which holds the filename of the latest
             version of the mod being downloaded
+        :param extract_path: The directory to extract the tarball into
 
         :return: Returns true on a file download false if nothing changed
         """
         latest_url = f"{url_prefix}/{version}/{latest_suffix}"
-        resp = requests.get(latest_url)
+        resp = self.http.get(latest_url)
         if resp.status_code != 200:
             raise Exception(
                 f"Error retrieving latest metamod/sourcemod version: {latest_suffix}"
@@ -300,27 +594,61 @@ class ServerBase:
         download_url = f"{url_prefix}/{version}/{download_file}"
 
         if install_path.is_file():
-            resp = requests.head(download_url)
-            remote_size = resp.headers["Content-Length"]
-            local_size = str(install_path.stat().st_size)
-
-            remote_ts = parsedate_to_datetime(resp.headers["Last-Modified"])
-            local_ts = datetime.fromtimestamp(
-                install_path.stat().st_mtime,
-                datetime.now().astimezone().tzinfo,
-            )
-
-            time_diff = remote_ts - local_ts
+            resp = self.http.head(download_url)
+            local_stat = install_path.stat()
+            remote_size = int(resp.headers.get("Content-Length", "-1"))
+            up_to_date = remote_size == local_stat.st_size
+
+            # Only compare timestamps when the server sends Last-Modified
+            remote_modified = resp.headers.get("Last-Modified")
+            if up_to_date and remote_modified is not None:
+                remote_ts = parsedate_to_datetime(remote_modified)
+                local_ts = datetime.fromtimestamp(
+                    local_stat.st_mtime,
+                    datetime.now().astimezone().tzinfo,
+                )
+                up_to_date = remote_ts < local_ts
 
-            if remote_size == local_size and time_diff.days < 0:
+            if up_to_date:
                 LOG.info(f"{download_file} already installed, skipping")
                 return False
 
         LOG.debug(resp.headers)
         LOG.info(f"Downloading metamod from {download_url}")
-        self._download_file(download_url, install_path)
+        self._download_and_extract(download_url, install_path, extract_path)
         return True
 
+    def _download_and_extract(
+        self, file_url: str, file_path: Path, extract_path: str
+    ) -> None:
+        """
+        Downloads a gzipped tarball, extracting it while it streams in and
+        keeping a copy of the tarball on disk
+
+        :param file_url: The URL to download from
+        :param file_path: The path to store the tarball on disk
+        :param extract_path: The directory to extract the tarball into
+        """
+        with self.http.get(file_url, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            with open(file_path.absolute(), "wb") as f:
+                with tarfile.open(
+                    fileobj=_TeeReader(r.raw, f), mode="r|gz"
+                ) as tar:
+                    members = _changed_members(tar, extract_path)
+                    # The data filter blocks unsafe members such as absolute
+                    # paths, it's only available on newer Python releases
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(
+                            extract_path, members=members, filter="data"
+                        )
+                    else:
+                        tar.extractall(extract_path, members=members)
+                # tarfile stops reading at the end of archive marker, keep
+                # any trailing padding so the local copy is complete
+                copyfileobj(r.raw, f, length=self.download_chunk_size)
+
     def _install_metamod(self, version: str = "1.11") -> None:
         """
         Downloads and installs metamod
@@ -331,18 +659,14 @@ class ServerBase:
         if not self.SOURCE_MOD_GAME:
             LOG.warn("SOURCE_MOD_GAME not set, skipping metamod install")
 
-        file_changed = self._allied_mods_download(
+        self._allied_mods_download(
             Path(f"{self.addons_path}/metamod.tar.gz"),
             "https://mms.alliedmods.net/mmsdrop",
             version,
-            f"mmsource-latest-{platform.system().lower()}",
+            f"mmsource-latest-{_SYSTEM_LOWER}",
+            self.game_path,
         )
 
-        if file_changed:
-            tar = tarfile.open(f"{self.addons_path}/metamod.tar.gz", "r:gz")
-            tar.extractall(self.game_path)
-            tar.close
-
     def _install_sourcemod(self, version: str = "1.10") -> None:
         """
         Downloads and installs sourcemod
@@ -353,18 +677,14 @@ class ServerBase:
         if not self.SOURCE_MOD_GAME:
             LOG.warn("SOURCE_MOD_GAME not set, skipping sourcemod install")
 
-        file_changed = self._allied_mods_download(
+        self._allied_mods_download(
             Path(f"{self.addons_path}/sourcemod.tar.gz"),
             "https://sm.alliedmods.net/smdrop",
             version,
-            f"sourcemod-latest-{platform.system().lower()}",
+            f"sourcemod-latest-{_SYSTEM_LOWER}",
+            self.game_path,
         )
 
-        if file_changed:
-            tar = tarfile.open(f"{self.addons_path}/sourcemod.tar.gz", "r:gz")
-            tar.extractall(self.game_path)
-            tar.close
-
     def create_sourcemod_groups(self, groups: list) -> None:
         """
         Replaces the sourcemod admin_groups.cfg file with content from a template
@@ -409,41 +729,49 @@ class ServerBase:
         :param settings: A set of key pair values of settings to add/replace
             in the server.cfg file
         """
-        keys = list(settings.keys())
+        # Maps the encoded setting names still to be written to their keys
+        remaining = {key.encode("UTF-8"): key for key in settings}
         infile_path = Path(f"{self.game_path}/cfg/server.cfg")
         outfile_path = Path(f"{infile_path}.new")
 
-        if infile_path.exists():
-            with open(infile_path, "r") as infile, open(
-                outfile_path, "w"
-            ) as outfile:
-                for line in infile:
-                    if not line[0:2] == "//":
-                        setting_key = None
-                        splits = line.split()
-                        if len(splits) != 0:
-                            setting_key = splits[0]
-                        if setting_key in keys:
-                            keys.remove(setting_key)
-                            if isinstance(settings[setting_key], str):
-                                line = f'{setting_key} "{settings[setting_key]}"{ls}'
-                            elif isinstance(settings[setting_key], int):
-                                line = f"{setting_key} {settings[setting_key]}{ls}"
-
-                    outfile.write(line)
-
-        with open(outfile_path, "a") as outfile:
-            for key in keys:
-                if isinstance(settings[key], str):
-                    outfile.write(f'{key} "{settings[key]}"{ls}')
-                elif isinstance(settings[key], int):
-                    outfile.write(f"{key} {settings[key]}{ls}")
-
-            for config in exec_configs:
-                outfile.write(f"exec {config}{ls}")
-
-            outfile.write(f"writeid{ls}")
-            outfile.write(f"writeip{ls}")
+        def replace_setting(match):
+            key = remaining.pop(match.group(1), None)
+            if key is None:
+                return match.group(0)
+            line = _format_setting(key, settings[key])
+            if line is None:
+                return match.group(0)
+            return line.encode("UTF-8")
+
+        content = b""
+        if infile_path.exists() and infile_path.stat().st_size > 0:
+            with open(infile_path, "rb") as infile, mmap(
+                infile.fileno(), 0, access=ACCESS_READ
+            ) as mm:
+                content = _CFG_SETTING_RE.sub(replace_setting, mm)
+
+        lines = [
+            _format_setting(key, settings[key]) for key in remaining.values()
+        ]
+        lines += [f"exec {config}" for config in exec_configs]
+        lines += ["writeid", "writeip"]
+
+        # Appended lines follow the existing file's line endings so a CRLF
+        # server.cfg doesn't end up mixed
+        if b"\r\n" in content:
+            newline = "\r\n"
+        elif content:
+            newline = "\n"
+        else:
+            newline = ls
+        if content and not content.endswith(b"\n"):
+            content += newline.encode("UTF-8")
+        content += "".join(
+            f"{line}{newline}" for line in lines if line is not None
+        ).encode("UTF-8")
+
+        with open(outfile_path, "wb") as outfile:
+            outfile.write(content)
 
         outfile_path.rename(infile_path)
 
@@ -0,0 +1,109 @@
+from os import replace
+from time import time
+from pathlib import Path
+from hashlib import sha256
+
+import json
+import logging
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.NullHandler())
+
+
+class CacheEntry:
+    def __init__(self, body: dict, expires_at: float, date: str = None):
+        """
+        A cached Steam API response
+
+        :param body: The decoded JSON body of the response
+        :param expires_at: Unix timestamp after which the entry is stale
+        :param date: The Date header of the response, used to revalidate the
+            entry with If-Modified-Since once it has expired
+        """
+        self.body = body
+        self.expires_at = expires_at
+        self.date = date
+
+    def is_expired(self) -> bool:
+        return time() >= self.expires_at
+
+
+class MetadataCache:
+    def __init__(
+        self, cache_path: str = "~/.cache/steamcmd/meta", ttl: int = 3600
+    ) -> None:
+        """
+        Stores Steam API metadata responses on disk so repeat lookups of the
+        same IDs can skip the request while the entry is fresh.
+
+        :param cache_path: The directory to store cached responses in
+        :param ttl: The number of seconds a cached response is considered fresh
+        """
+        self.cache_path = Path(cache_path).expanduser()
+        self.ttl = ttl
+
+    def key(self, url: str, ids: list) -> str:
+        """
+        Builds the cache key for a request, the order of the IDs is ignored
+
+        :param url: The Steam API URL being queried
+        :param ids: The IDs being looked up
+
+        :return: A hex digest identifying the request
+        """
+        ids = ",".join(sorted(str(i) for i in ids))
+        return sha256(f"{url}|{ids}".encode("UTF-8")).hexdigest()
+
+    def get(self, key: str) -> CacheEntry:
+        """
+        :param key: The key returned by MetadataCache.key
+
+        :return: The cached entry, or None if nothing usable is cached or the
+            entry can't be read
+        """
+        entry_path = self.cache_path / f"{key}.json"
+        try:
+            data = json.loads(entry_path.read_text())
+            return CacheEntry(data["body"], data["expires_at"], data["date"])
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            LOG.warning(f"Unable to read cache entry {entry_path}: {e}")
+            return None
+        except (ValueError, KeyError, TypeError):
+            LOG.warning(f"Ignoring unreadable cache entry {entry_path}")
+            return None
+
+    def set(self, key: str, body: dict, date: str = None) -> None:
+        """
+        Stores a response, replacing any existing entry for the key. Errors
+        writing to the cache directory are logged and otherwise ignored.
+
+        :param key: The key returned by MetadataCache.key
+        :param body: The decoded JSON body of the response
+        :param date: The Date header of the response
+        """
+        entry_path = self.cache_path / f"{key}.json"
+        tmp_path = self.cache_path / f"{key}.json.tmp"
+        try:
+            self.cache_path.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_text(
+                json.dumps(
+                    {
+                        "body": body,
+                        "expires_at": time() + self.ttl,
+                        "date": date,
+                    }
+                )
+            )
+            # Write then rename so concurrent readers never see a partial
+            # entry
+            replace(tmp_path, entry_path)
+        except OSError as e:
+            # The cache is only an optimisation, failing to write it
+            # shouldn't fail the lookup that produced the response
+            LOG.warning(f"Unable to write cache entry {entry_path}: {e}")
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
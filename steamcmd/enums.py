@@ -1,13 +1,15 @@
 import platform
 
+# The operating system can't change while running, so look it up once
+_SYSTEM = platform.system()
+_SYSTEM_LOWER = _SYSTEM.lower()
+_PLATFORM_MAP = {"Linux": 0, "Windows": 1}
+
 
 def _from_platform(linux: int, windows: int) -> int:
-    if platform.system() == "Linux":
-        return linux
-    elif platform.system() == "Windows":
-        return windows
-    else:
+    if _SYSTEM not in _PLATFORM_MAP:
         raise Exception("Unsupported Operating System")
+    return (linux, windows)[_PLATFORM_MAP[_SYSTEM]]
 
 
 class AppIds:
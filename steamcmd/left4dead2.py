@@ -2,6 +2,7 @@ from .base import ServerBase
 from .enums import AppIds
 
 from sys import executable as python_bin
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Left4Dead2Server(ServerBase):
@@ -15,6 +16,8 @@ class Left4Dead2Server(ServerBase):
         password: str = None,
         server_ref: str = "0",
         install_sourcemod: bool = True,
+        metadata_cache_path: str = "~/.cache/steamcmd/meta",
+        metadata_cache_ttl: int = 3600,
     ) -> None:
         """
         This class is designed to help simplify installing applications using
@@ -33,6 +36,10 @@ class Left4Dead2Server(ServerBase):
             authentication to download, this is how to provide the password
         :param server_ref: A reference for the server, gets appended to the
             install path
+        :param metadata_cache_path: Directory used to cache Steam API
+            workshop metadata, set to None to disable the cache
+        :param metadata_cache_ttl: The number of seconds cached Steam API
+            metadata is used before being revalidated
         """
         super().__init__(
             app_id=app_id,
@@ -43,6 +50,8 @@ class Left4Dead2Server(ServerBase):
             password=password,
             server_ref=server_ref,
             install_sourcemod=install_sourcemod,
+            metadata_cache_path=metadata_cache_path,
+            metadata_cache_ttl=metadata_cache_ttl,
         )
         self.SOURCE_MOD_GAME = True
         self.game_path = f"{self.install_path}/left4dead2"
@@ -88,5 +97,14 @@ class Left4Dead2Server(ServerBase):
             )
 
         if self.install_sourcemod:
-            self._install_metamod()
-            self._install_sourcemod()
+            # metamod and sourcemod are separate downloads so they can be
+            # installed concurrently, both extract under addons/ which
+            # _download_and_extract tolerates by creating parent
+            # directories itself
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                list(
+                    ex.map(
+                        lambda install: install(),
+                        [self._install_metamod, self._install_sourcemod],
+                    )
+                )
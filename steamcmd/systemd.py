@@ -50,10 +50,15 @@ if __name__ == "__main__":
     if not proc.exists():
         raise Exception("Process stdin file descriptor does not exist")
 
-    for i, cmd in enumerate(args.cmd, start=1):
-        with open(proc, "w") as fd:
-            fd.write(cmd)
-            if not args.no_newline:
-                fd.write(f"{ls}")
-        if not i == len(args.cmd):
-            sleep(args.cmd_delay)
+    newline = "" if args.no_newline else ls
+    cmds = [f"{cmd}{newline}".encode() for cmd in args.cmd]
+
+    # Unbuffered so each write reaches the process as soon as it's made
+    with open(proc, "wb", buffering=0) as fd:
+        if args.cmd_delay == 0:
+            fd.write(b"".join(cmds))
+        else:
+            for i, cmd in enumerate(cmds, start=1):
+                fd.write(cmd)
+                if not i == len(cmds):
+                    sleep(args.cmd_delay)